@@ -1,5 +1,7 @@
 import os
-import numpy as np
+import copy
+import functools
+import contextlib
 import pandas as pd
 from tqdm import tqdm as _tqdm
 from ptflops import get_model_complexity_info
@@ -7,10 +9,14 @@ from ptflops import get_model_complexity_info
 import torch
 import torch.nn as nn
 import torch.nn.functional as f
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 from torchvision.datasets import PCAM
 import torchvision.transforms as transforms
+import torchvision.transforms.functional as tf
 from torcheval.metrics import MulticlassAUROC, MulticlassAccuracy
+from torcheval.metrics.toolkit import sync_and_compute
 
 # from models.swin_transformer_v2 import SwinTransformerV2    # Original Swin Transformer
 from models.simple_swin_v2 import SwinTransformerV2    # Original Swin Transformer without gradcam stuff
@@ -30,19 +36,73 @@ from models.simple_swin_v2 import SwinTransformerV2    # Original Swin Transform
 import requests
 import io
 
+# Optimization
+torch.set_float32_matmul_precision('high')  # Allow TF32 Tensor Cores for FP32 matmuls (Ampere+)
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True  # Input shapes are fixed, so autotune conv algorithms once and reuse them
+
+# ImageNet normalization statistics (applied on device, see to_device())
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# CNN backbones that run faster in NHWC (channels last) memory format, transformers are layout insensitive
+CHANNELS_LAST_MODELS = {'AlexNet', 'VGG', 'GoogLeNet', 'Inception3', 'ResNet', 'DenseNet'}
+
+
 def uniquify(path):
     """
     Creates unique path name by appending number if given path already exists
     """
 
-    filename, extension = os.path.splitext(path)
+    folder, name = os.path.split(path)
+    filename, extension = os.path.splitext(name)
     counter = 1
 
-    while os.path.exists(path):
-        path = filename + "_" + str(counter) + extension
+    # Scan parent folder once instead of checking every candidate path
+    try:
+        with os.scandir(folder or '.') as entries:
+            existing = {entry.name for entry in entries}
+    except FileNotFoundError:  # Parent folder doesn't exist yet, so neither does the path
+        return path
+
+    while name in existing:
+        name = filename + "_" + str(counter) + extension
         counter += 1
 
-    return path
+    return os.path.join(folder, name)
+
+
+def is_distributed():
+    """
+    Checks if running in an initialized distributed process group
+    """
+
+    return dist.is_available() and dist.is_initialized()
+
+
+def mean_loss(loss_sum, loss_count):
+    """
+    Calculates mean loss from running sum (over all processes in distributed training)
+    """
+
+    if is_distributed():
+        totals = torch.stack([loss_sum, torch.tensor(float(loss_count), device=loss_sum.device)])
+        dist.all_reduce(totals)
+        loss_sum, loss_count = totals[0], totals[1]
+
+    return (loss_sum / loss_count).item()
+
+
+def compute_metric(metric):
+    """
+    Computes metric (over all processes in distributed training)
+    """
+
+    if is_distributed():
+        return sync_and_compute(metric, recipient_rank='all').item()
+
+    return metric.compute().item()
 
 
 def tqdm(*args, **kwargs):
@@ -53,61 +113,264 @@ def tqdm(*args, **kwargs):
     return _tqdm(*args, **kwargs, mininterval=1)  # Safety, do not overflow buffer
 
 
-def get_dataloaders(data_path, batch_size, train=True, shuffle=True, download=True, resize=96, augment=False, normalize=True):
+class CachedPCAM(Dataset):
     """
-    Creates dataloaders from dataset
+    Wraps PCAM dataset and caches the decoded uint8 images on first access, so that following epochs do not read from
+    the HDF5 files again. With shared=True the cache is allocated in shared memory (/dev/shm) to be visible to all
+    dataloader workers, which needs about 7.2 GB for the train split (Docker only provides 64 MB by default, increase
+    it with --shm-size)
     """
 
-    # Preprocessing
+    def __init__(self, dataset, transform=None, shared=True):
+        self.dataset = dataset
+        self.transform = transform
+
+        num_samples = len(dataset)
+        image_shape = tf.pil_to_tensor(dataset[0][0]).shape
+        self.images = torch.empty((num_samples, *image_shape), dtype=torch.uint8)
+        self.targets = torch.empty(num_samples, dtype=torch.long)
+        self.cached = torch.zeros(num_samples, dtype=torch.bool)
+        if shared:
+            self.images.share_memory_()
+            self.targets.share_memory_()
+            self.cached.share_memory_()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        # Decode sample only the first time it is accessed
+        if not self.cached[idx]:
+            image, target = self.dataset[idx]
+            self.images[idx] = tf.pil_to_tensor(image)
+            self.targets[idx] = target
+            self.cached[idx] = True
+
+        image = self.images[idx]
+        target = int(self.targets[idx])
+        if self.transform is not None:
+            image = self.transform(image)
+
+        return image, target
+
+
+def get_dataloaders(data_path, batch_size, train=True, shuffle=True, download=True, resize=96, augment=False, cache=False,
+                    num_workers=(os.cpu_count() or 2) // 2, pin_memory=True, persistent_workers=True, prefetch_factor=4):
+    """
+    Creates dataloaders from dataset (images are kept as uint8, conversion and normalization are done in to_device())
+    """
+
+    # Preprocessing (cached datasets already return tensors)
     preprocess_list = [
-        transforms.ToTensor(),
         transforms.Resize(resize, antialias=True)
     ]
+    if not cache:
+        preprocess_list.insert(0, transforms.PILToTensor())
 
     # Data augmentations
     if augment is True:
         augment_list = [
             # transforms.RandomResizedCrop(resize, antialias=True),
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomVerticalFlip(),
+            # Horizontal and vertical flips are applied per batch on device, see random_flip()
             # transforms.ColorJitter()
         ]
     else:
         augment_list = []
 
-    # Normalization
-    if normalize:
-        normalize_list = [
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ]
-    else:
-        normalize_list = []
-
     if train:
-        train_transform = transforms.Compose(
-            preprocess_list + augment_list + normalize_list)  # Apply data augments only in train
+        train_transform = transforms.Compose(preprocess_list + augment_list)  # Apply data augments only in train
         print(f'Train Transforms:')
         print(train_transform)
 
-    testval_transform = transforms.Compose(preprocess_list + normalize_list)
+    testval_transform = transforms.Compose(preprocess_list)
+
+    if cache:  # Transforms are applied by the cache wrapper on top of the cached images
+        def get_dataset(split, transform):
+            return CachedPCAM(PCAM(root=data_path, split=split, download=download), transform=transform,
+                              shared=num_workers > 0)  # Without workers the cache doesn't need to be in shared memory
+    else:
+        def get_dataset(split, transform):
+            return PCAM(root=data_path, split=split, download=download, transform=transform)
 
     if train:
-        train_dataset = PCAM(root=data_path, split='train', download=download, transform=train_transform)
-        val_dataset = PCAM(root=data_path, split='val', download=download, transform=testval_transform)
-    test_dataset = PCAM(root=data_path, split='test', download=download, transform=testval_transform)
+        train_dataset = get_dataset('train', train_transform)
+        val_dataset = get_dataset('val', testval_transform)
+    test_dataset = get_dataset('test', testval_transform)
+
+    # Loading options (worker processes, pinned memory for faster data transfer to GPU)
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:  # Only valid with worker processes
+        loader_kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
 
     if train:
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, pin_memory=True) # set pin_memory=True for faster data transfer to GPU
-        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=shuffle)
+        if is_distributed():  # Each process trains and validates on its own shard of the dataset
+            train_sampler = DistributedSampler(train_dataset, shuffle=shuffle, drop_last=True)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, drop_last=True,
+                                      **loader_kwargs)
+            val_sampler = DistributedSampler(val_dataset, shuffle=shuffle)
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, sampler=val_sampler, **loader_kwargs)
+        else:
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, drop_last=True,
+                                      **loader_kwargs)  # Drop last incomplete batch to keep input shapes static for compiled model
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=shuffle, **loader_kwargs)
     else:
         train_loader = None
         val_loader = None
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)  # Do not shuffle so that uncertainty quantification can work (consistent order across runs)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)  # Do not shuffle so that uncertainty quantification can work (consistent order across runs)
 
     return train_loader, val_loader, test_loader
 
 
-def get_model(model_name, device, all_linears=False):
+@functools.lru_cache(maxsize=None)
+def get_normalization(device):
+    """
+    Returns normalization mean and std as broadcastable tensors, cached per device
+    """
+
+    mean = torch.tensor(IMAGENET_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=device).view(1, 3, 1, 1)
+
+    return mean, std
+
+
+def to_device(inputs, device, memory_format=torch.contiguous_format, normalize=True):
+    """
+    Moves uint8 image batch to device and converts it to normalized float there (4x less data to transfer)
+    """
+
+    inputs = inputs.to(device, non_blocking=True, memory_format=memory_format)
+    inputs = inputs.float().div_(255)
+    if normalize:
+        mean, std = get_normalization(device)
+        inputs = inputs.sub_(mean).div_(std)
+
+    return inputs
+
+
+def random_flip(inputs):
+    """
+    Flips each image of batch horizontally and vertically with probability 0.5 (on the device of the batch)
+    """
+
+    flip_h = torch.rand(inputs.size(0), 1, 1, 1, device=inputs.device) < 0.5
+    flip_v = torch.rand(inputs.size(0), 1, 1, 1, device=inputs.device) < 0.5
+    inputs = torch.where(flip_h, inputs.flip(-1), inputs)  # No boolean indexing, so no synchronization with CPU
+    inputs = torch.where(flip_v, inputs.flip(-2), inputs)
+
+    return inputs
+
+
+class CUDAPrefetcher:
+    """
+    Wraps dataloader and moves the next batch to device on a side CUDA stream while the current batch is processed
+    (falls back to plain synchronous transfer on CPU)
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format, normalize=True):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.normalize = normalize
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.iterator = None
+        self.batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def __next__(self):
+        if self.batch is None:
+            raise StopIteration
+
+        inputs, labels = self.batch
+        if self.stream is not None:
+            # Wait for the transfer and tell the allocator that the tensors are now used by the main stream
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            inputs.record_stream(current_stream)
+            labels.record_stream(current_stream)
+
+        self.preload()
+
+        return inputs, labels
+
+    def preload(self):
+        """
+        Starts moving the next batch to device
+        """
+
+        try:
+            inputs, labels = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+
+        if self.stream is None:
+            self.batch = (to_device(inputs, self.device, self.memory_format, self.normalize), labels.to(self.device))
+        else:
+            with torch.cuda.stream(self.stream):
+                self.batch = (to_device(inputs, self.device, self.memory_format, self.normalize),
+                              labels.to(self.device, non_blocking=True))
+
+
+def preload_to_device(loader, device):
+    """
+    Loads whole dataset of dataloader to device as uint8 tensors (pass them to test() to reuse them across test runs)
+    """
+
+    num_samples = len(loader.dataset)
+    image_shape = loader.dataset[0][0].shape
+    images = torch.empty((num_samples, *image_shape), dtype=torch.uint8, device=device)
+    targets = torch.empty(num_samples, dtype=torch.long, device=device)
+
+    offset = 0
+    for inputs, labels in tqdm(loader, desc='Preloading'):
+        batch_len = labels.size(0)
+        images[offset:offset + batch_len].copy_(inputs, non_blocking=True)
+        targets[offset:offset + batch_len].copy_(labels, non_blocking=True)
+        offset += batch_len
+
+    return images, targets
+
+
+# GFLOPS per model and image size, they do not change across runs
+_gflops_cache = {}
+
+
+def get_gflops(model, image_size):
+    """
+    Calculates GFLOPS of model for a single image (cached per model and image size)
+    """
+
+    model_name = getattr(model, 'model_name', None)
+    all_linears = getattr(model, 'all_linears', False)
+    key = (model_name or type(model), all_linears, image_size, sum(p.numel() for p in model.parameters()))
+    if key not in _gflops_cache:
+        # Count on an eager copy on CPU (layer hooks are not reliable inside a compiled graph, and the memory of the
+        # device is kept for testing)
+        if model_name is not None:
+            eager_model = build_model(model_name, all_linears)
+        else:  # Not created by get_model(), so not compiled either
+            eager_model = copy.deepcopy(model).cpu()
+        with torch.no_grad():
+            macs, _ = get_model_complexity_info(eager_model, image_size,
+                                                as_strings=False, print_per_layer_stat=False, verbose=False)
+        _gflops_cache[key] = 2 * macs / 1000000000
+
+    return _gflops_cache[key]
+
+
+@functools.lru_cache(maxsize=None)
+def load_pretrained(model_name):
+    """
+    Loads pretrained model (cached, so sweeps in a single process load each set of weights only once)
+    """
+
     model_dir = {'AlexNet': (alexnet, AlexNet_Weights.IMAGENET1K_V1),
                  'VGG-11': (vgg11, VGG11_Weights.IMAGENET1K_V1),
                  'VGG-16': (vgg16, VGG16_Weights.IMAGENET1K_V1),
@@ -138,8 +401,16 @@ def get_model(model_name, device, all_linears=False):
         model.load_state_dict(checkpoint['model'])
     else:
         model = model_dir[model_name][0](weights=model_dir[model_name][1])
-    model.to(device)
-    print(f'Selected Model: {model.__class__.__name__}\n')
+
+    return model
+
+
+def build_model(model_name, all_linears=False):
+    """
+    Builds pretrained model with frozen layers and new classification layers (eager and on CPU)
+    """
+
+    model = copy.deepcopy(load_pretrained(model_name))  # Copy, so changes to the layers do not affect the cached model
 
     # Freeze all layers
     for param in model.parameters():
@@ -197,12 +468,36 @@ def get_model(model_name, device, all_linears=False):
     return model
 
 
+def get_model(model_name, device, all_linears=False):
+    model = build_model(model_name, all_linears)
+    model.to(device)
+    print(f'Selected Model: {model.__class__.__name__}\n')
+
+    # Remember how model was built (to identify it and rebuild it in eager mode, see get_gflops())
+    model.model_name = model_name
+    model.all_linears = all_linears
+
+    # Use channels last memory format for CNNs (native layout of Tensor Core convolutions)
+    if model.__class__.__name__ in CHANNELS_LAST_MODELS:
+        model.to(memory_format=torch.channels_last)
+
+    # Compile model (operator fusion and CUDA graphs, only on GPU). Graph replays overwrite the outputs of the previous
+    # replay, so outputs that are kept across batches (e.g. by the metrics) must be cloned
+    if device.type == 'cuda':
+        model.compile(mode='reduce-overhead', dynamic=False)  # In-place, so class name and state dict keys are kept
+
+    return model
+
+
 def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_epochs, num_classes, device,
-          augment=False, save_ckpt_path=None, load_ckpt_path=None, logger=None, run=None):
+          augment=False, normalize=True, accum_steps=1, save_ckpt_path=None, load_ckpt_path=None, logger=None, run=None):
     """
-    Trains model
+    Trains model (with gradients accumulated over accum_steps batches, and distributed if process group is initialized)
     """
 
+    if accum_steps < 1:
+        raise ValueError(f'accum_steps must be at least 1, got {accum_steps}')
+
     model.to(device)
 
     if 'Inception' in model.__class__.__name__:
@@ -222,8 +517,22 @@ def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_e
     val_acc_arr = []
 
     # Create metric monitors
-    auc = MulticlassAUROC(num_classes=num_classes)
-    accuracy = MulticlassAccuracy()
+    auc = MulticlassAUROC(num_classes=num_classes, device=device)  # Kept on device, so updates do not copy to CPU
+    accuracy = MulticlassAccuracy(device=device)
+
+    # Mixed precision (only on GPU, CPU runs stay in FP32)
+    use_amp = device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+    # Memory format of the inputs (must match the model)
+    memory_format = torch.channels_last if model.__class__.__name__ in CHANNELS_LAST_MODELS else torch.contiguous_format
+
+    # Distributed training (the wrapper is only used for the forward pass, the model itself is saved)
+    distributed = is_distributed()
+    if distributed:
+        net = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    else:
+        net = model
 
     for epoch in range(num_epochs):
 
@@ -231,30 +540,55 @@ def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_e
         model.train()
 
         # Initialize the running loss and metrics
-        loss_arr = []
+        loss_sum = torch.zeros((), device=device)
+        loss_count = 0
         auc.reset()
         accuracy.reset()
 
-        # Train
-        for inputs, labels in tqdm(train_loader, desc=f'Epoch {epoch + 1}/{num_epochs}, Training'):
-            # Move the inputs and labels to the device
-            inputs = inputs.float().to(device)
-            labels = labels.to(device)
-
-            # Zero the optimizer gradients
-            optimizer.zero_grad()
-
-            # Forward pass
-            logits = model(inputs)
-            _, preds = torch.max(logits, 1)
-            loss = loss_fun(logits, labels)
+        # Shuffle differently across epochs in distributed training
+        for loader in (train_loader, val_loader):
+            if isinstance(loader.sampler, DistributedSampler):
+                loader.sampler.set_epoch(epoch)
 
-            # Backward pass and optimizer step
-            loss.backward()
-            optimizer.step()
+        # Zero the optimizer gradients
+        optimizer.zero_grad(set_to_none=True)  # Release gradients instead of filling them with zeros
 
-            # Update the running loss and metrics
-            loss_arr.append(loss.item())
+        # Train
+        num_batches = len(train_loader)
+        for i, (inputs, labels) in enumerate(tqdm(CUDAPrefetcher(train_loader, device, memory_format, normalize),
+                                                  desc=f'Epoch {epoch + 1}/{num_epochs}, Training')):
+            # Start new CUDA graph step (outputs of the previous iteration are no longer used by the graphs)
+            torch.compiler.cudagraph_mark_step_begin()
+
+            # Data augmentations
+            if augment:
+                inputs = random_flip(inputs)
+
+            # Only step (and synchronize gradients across processes) on the last batch of each accumulation, the last
+            # accumulation of the epoch may be shorter
+            optimizer_step = (i + 1) % accum_steps == 0 or i + 1 == num_batches
+            window = min(accum_steps, num_batches - i // accum_steps * accum_steps)
+            sync_context = net.no_sync() if distributed and not optimizer_step else contextlib.nullcontext()
+
+            with sync_context:
+                # Forward pass
+                with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
+                    logits = net(inputs)
+                    loss = loss_fun(logits, labels)
+
+                # Backward pass (loss is scaled to avoid FP16 gradient underflow)
+                scaler.scale(loss / window).backward()
+
+            # Optimizer step
+            if optimizer_step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+            # Update the running loss and metrics (loss and metric states are on device, no synchronization per batch)
+            loss_sum += loss.detach()
+            loss_count += 1
+            logits = logits.detach().clone()  # Metrics keep the logits, which the next graph replay would overwrite
             auc.update(logits, labels)  # AUC handles logits accordingly
             accuracy.update(logits, labels)  # Accuracy too
 
@@ -262,9 +596,9 @@ def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_e
         scheduler.step()
 
         # Calculate the loss and metrics
-        train_loss = np.average(loss_arr)
-        train_acc = accuracy.compute().item()
-        train_auc = auc.compute().item()
+        train_loss = mean_loss(loss_sum, loss_count)
+        train_acc = compute_metric(accuracy)
+        train_auc = compute_metric(auc)
 
         # Log the loss and metrics
         train_loss_arr.append(train_loss)
@@ -279,31 +613,34 @@ def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_e
         model.eval()
 
         # Initialize the running loss and metrics
-        loss_arr = []
+        loss_sum = torch.zeros((), device=device)
+        loss_count = 0
         auc.reset()
         accuracy.reset()
 
         # Validate
-        with torch.no_grad():
-            for inputs, labels in tqdm(val_loader, desc=f'Epoch {epoch + 1}/{num_epochs}, Validation'):
-                # Move the inputs and labels to the device
-                inputs = inputs.float().to(device)
-                labels = labels.to(device)
+        with torch.inference_mode():
+            for inputs, labels in tqdm(CUDAPrefetcher(val_loader, device, memory_format, normalize),
+                                       desc=f'Epoch {epoch + 1}/{num_epochs}, Validation'):
+                # Start new CUDA graph step
+                torch.compiler.cudagraph_mark_step_begin()
 
                 # Forward pass
-                logits = model(inputs)
-                _, preds = torch.max(logits, 1)
-                loss = loss_fun(logits, labels)
+                with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
+                    logits = model(inputs)  # No gradients to synchronize, so no need for the distributed wrapper
+                    loss = loss_fun(logits, labels)
 
                 # Update the running loss and metrics
-                loss_arr.append(loss.item())
+                loss_sum += loss
+                loss_count += 1
+                logits = logits.clone()  # Metrics keep the logits, which the next graph replay would overwrite
                 auc.update(logits, labels)
                 accuracy.update(logits, labels)
 
         # Calculate the validation loss, accuracy and AUC
-        val_loss = np.average(loss_arr)
-        val_acc = accuracy.compute().item()
-        val_auc = auc.compute().item()
+        val_loss = mean_loss(loss_sum, loss_count)
+        val_acc = compute_metric(accuracy)
+        val_auc = compute_metric(auc)
 
         # Log the loss and metrics
         val_loss_arr.append(val_loss)
@@ -319,47 +656,56 @@ def train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_e
             'Train Loss: {:.4f}, Train Acc: {:.4f}, Train AUC: {:.4f}, \n Val Loss: {:.4f}, Val Acc: {:.4f}, Val AUC: {:.4f}'
             .format(train_loss, train_acc, train_auc, val_loss, val_acc, val_auc))
 
-    # Save model
-    if save_ckpt_path is None:
-        save_ckpt_folder = os.path.join('models',
-                                        f'{model.__class__.__name__}_lr{str(optimizer.defaults["lr"]).split(".")[1]}_epoch{num_epochs}' + ('_augment' if augment else ''))
-        save_ckpt_folder = uniquify(
-            save_ckpt_folder)  # Create unique folder name by appending number if given path already exists
-
-        save_ckpt_path = os.path.join(save_ckpt_folder, f'{model.__class__.__name__}.pt')
-
-        if not os.path.exists('models'):  # If folder 'models' doesn't exist, create it
-            os.makedirs('models')
-        if not os.path.exists(save_ckpt_folder):  # If model folder doesn't exist, create it
-            os.makedirs(save_ckpt_folder)
-
-    torch.save({
-        'epochs': num_epochs,
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'train_loss': train_loss,
-        'train_acc': train_acc,
-        'train_auc': train_auc,
-        'val_loss': val_loss,
-        'val_acc': val_acc,
-        'val_auc': val_auc,
-    }, save_ckpt_path)
-    print(f'Saved checkpoint at: {save_ckpt_path}\n')
-
-    # Save learning curve
-    curve = pd.DataFrame(
-        {'model': model.__class__.__name__,
-         'train_loss': train_loss_arr, 'train_acc': train_acc_arr, 'train_auc': train_auc_arr,
-         'val_loss': val_loss_arr, 'val_acc': val_acc_arr, 'val_auc': val_auc_arr}
-    )
-    save_curve_path = save_ckpt_path.split('.')[0] + '_curve.csv'
-    curve.to_csv(save_curve_path)
-    print(f'Saved curve at: {save_curve_path}\n')
+    # Save model (only once in distributed training)
+    if not distributed or dist.get_rank() == 0:
+        if save_ckpt_path is None:
+            save_ckpt_folder = os.path.join('models',
+                                            f'{model.__class__.__name__}_lr{str(optimizer.defaults["lr"]).split(".")[1]}_epoch{num_epochs}' + ('_augment' if augment else ''))
+            save_ckpt_folder = uniquify(
+                save_ckpt_folder)  # Create unique folder name by appending number if given path already exists
+
+            save_ckpt_path = os.path.join(save_ckpt_folder, f'{model.__class__.__name__}.pt')
+
+            if not os.path.exists('models'):  # If folder 'models' doesn't exist, create it
+                os.makedirs('models')
+            if not os.path.exists(save_ckpt_folder):  # If model folder doesn't exist, create it
+                os.makedirs(save_ckpt_folder)
+
+        torch.save({
+            'epochs': num_epochs,
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'train_loss': train_loss,
+            'train_acc': train_acc,
+            'train_auc': train_auc,
+            'val_loss': val_loss,
+            'val_acc': val_acc,
+            'val_auc': val_auc,
+        }, save_ckpt_path)
+        print(f'Saved checkpoint at: {save_ckpt_path}\n')
+
+        # Save learning curve
+        curve = pd.DataFrame(
+            {'model': model.__class__.__name__,
+             'train_loss': train_loss_arr, 'train_acc': train_acc_arr, 'train_auc': train_auc_arr,
+             'val_loss': val_loss_arr, 'val_acc': val_acc_arr, 'val_auc': val_auc_arr}
+        )
+        save_curve_path = save_ckpt_path.split('.')[0] + '_curve.csv'
+        curve.to_csv(save_curve_path)
+        print(f'Saved curve at: {save_curve_path}\n')
+
+    # Wait for the checkpoint and share its final path, so that all processes return the same path
+    if distributed:
+        dist.barrier()
+        save_ckpt_paths = [save_ckpt_path]
+        dist.broadcast_object_list(save_ckpt_paths, src=0)
+        save_ckpt_path = save_ckpt_paths[0]
 
     return save_ckpt_path
 
 
-def test(model, test_loader, loss_fun, num_classes, device, dropout=False, load_ckpt_path=None):
+def test(model, test_loader, loss_fun, num_classes, device, dropout=False, normalize=True, preloaded=None,
+         load_ckpt_path=None):
     """
     Tests model
     """
@@ -372,8 +718,8 @@ def test(model, test_loader, loss_fun, num_classes, device, dropout=False, load_
     model.to(device)
 
     # Create metric monitors
-    auc = MulticlassAUROC(num_classes=num_classes)
-    accuracy = MulticlassAccuracy()
+    auc = MulticlassAUROC(num_classes=num_classes, device=device)  # Kept on device, so updates do not copy to CPU
+    accuracy = MulticlassAccuracy(device=device)
 
     # Set the model to evaluation mode
     model.eval()
@@ -386,65 +732,87 @@ def test(model, test_loader, loss_fun, num_classes, device, dropout=False, load_
                 module.p = 0.3
 
     # Initialize the running loss and metrics
-    loss_arr = []
+    loss_sum = torch.zeros((), device=device)
+    loss_count = 0
     auc.reset()
     accuracy.reset()
 
-    # Initialize prediction and label list to save as file later
-    pos_probs_list = []  # Probabilities for positive class
-    neg_probs_list = []  # Probabilities for negative class
-    labels_list = []
+    # Mixed precision (only on GPU, FP16 like in validation since BF16 is not supported before Ampere)
+    use_amp = device.type == 'cuda'
+
+    # Memory format of the inputs (must match the model)
+    memory_format = torch.channels_last if model.__class__.__name__ in CHANNELS_LAST_MODELS else torch.contiguous_format
+
+    # Preallocate prediction and label tensors to save as file later (pinned for asynchronous copies from GPU)
+    num_samples = len(test_loader.dataset)
+    probs_all = torch.empty((num_samples, num_classes), dtype=torch.float, pin_memory=device.type == 'cuda')
+    labels_all = torch.empty(num_samples, dtype=torch.long, pin_memory=device.type == 'cuda')
+    offset = 0
+
+    # Batches either sliced from the test set preloaded on device (see preload_to_device()) or loaded by the dataloader
+    if preloaded is not None:
+        images, targets = preloaded
+        batch_size = test_loader.batch_size
+        batches = ((to_device(images[i:i + batch_size], device, memory_format, normalize), targets[i:i + batch_size])
+                   for i in range(0, num_samples, batch_size))
+    else:
+        batches = CUDAPrefetcher(test_loader, device, memory_format, normalize)
 
     # Test
-    with torch.no_grad():
-        for inputs, labels in tqdm(test_loader, desc='Testing'):
-            # Move the inputs and labels to the device
-            inputs = inputs.float().to(device)
-            labels = labels.to(device)
+    with torch.inference_mode():
+        for inputs, labels in tqdm(batches, total=len(test_loader), desc='Testing'):
+            # Start new CUDA graph step
+            torch.compiler.cudagraph_mark_step_begin()
 
             # Forward pass
-            logits = model(inputs)
-            _, preds = torch.max(logits, 1)
+            with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_amp):
+                logits = model(inputs)
+            logits = logits.float()  # Metrics and probabilities in full precision (copy, so safe from graph replays)
             loss = loss_fun(logits, labels)
 
             # Update the running loss and metrics
-            loss_arr.append(loss.item())
+            loss_sum += loss
+            loss_count += 1
             auc.update(logits, labels)
             accuracy.update(logits, labels)
 
-            # Update the list of all predictions and labels
+            # Fill in the predictions and labels of the batch
             probs = f.softmax(logits, dim=1)
-            pos_probs_list += probs[:, 1].detach().tolist()
-            neg_probs_list += probs[:, 0].detach().tolist()
-            labels_list += labels.detach().tolist()
+            batch_len = labels.size(0)
+            probs_all[offset:offset + batch_len].copy_(probs, non_blocking=True)
+            labels_all[offset:offset + batch_len].copy_(labels, non_blocking=True)
+            offset += batch_len
+
+    # Wait for the asynchronous copies to finish
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
 
     # Calculate the test loss, accuracy and AUC
-    test_loss = np.average(loss_arr)
-    test_acc = accuracy.compute().detach().numpy()
-    test_auc = auc.compute().detach().numpy()
+    test_loss = (loss_sum / loss_count).item()
+    test_acc = accuracy.compute().detach().cpu().numpy()
+    test_auc = auc.compute().detach().cpu().numpy()
 
     # Calculate GFLOPS
-    image_size = tuple(next(iter(test_loader))[0].shape[1:])
-    macs, _ = get_model_complexity_info(model, image_size,
-                                        as_strings=False, print_per_layer_stat=False, verbose=False)
-    gflops = 2 * macs / 1000000000
+    image_size = tuple(test_loader.dataset[0][0].shape)
+    gflops = get_gflops(model, image_size)
 
     # Print the test metrics
     print('GFLOPS: {:.4f}, Test Loss: {:.4f}, Test Acc: {:.4f}, Test AUC: {:.4f}'.format(gflops, test_loss, test_acc,
                                                                                          test_auc))
 
     # Save outputs and metrics
-    outputs = pd.DataFrame({'pos_probs': pos_probs_list, 'neg_probs': neg_probs_list, 'labels': labels_list})
+    outputs = pd.DataFrame({'pos_probs': probs_all[:, 1].numpy(), 'neg_probs': probs_all[:, 0].numpy(),
+                            'labels': labels_all.numpy()})
     metrics = pd.DataFrame(
         {'model': model.__class__.__name__, 'gflops': [gflops], 'test_loss': [test_loss], 'test_acc': [test_acc],
          'test_auc': [test_auc]})
     if load_ckpt_path is not None:
-        save_outputs_path = uniquify(load_ckpt_path.split('.')[0] + '_outputs.csv')  # Create unique file
+        save_outputs_path = uniquify(load_ckpt_path.split('.')[0] + '_outputs.parquet')  # Create unique file
         save_metrics_path = uniquify(load_ckpt_path.split('.')[0] + '_metrics.csv')
     else:
         save_folder = os.path.join('models', f'{model.__class__.__name__}')
 
-        save_outputs_path = uniquify(os.path.join(save_folder, f'{model.__class__.__name__}_outputs.csv'))
+        save_outputs_path = uniquify(os.path.join(save_folder, f'{model.__class__.__name__}_outputs.parquet'))
         save_metrics_path = uniquify(os.path.join(save_folder, f'{model.__class__.__name__}_metrics.csv'))
 
         if not os.path.exists('models'):  # If folder 'models' doesn't exist, create it
@@ -452,7 +820,7 @@ def test(model, test_loader, loss_fun, num_classes, device, dropout=False, load_
         if not os.path.exists(save_folder):  # If model folder doesn't exist, create it
             os.makedirs(save_folder)
 
-    outputs.to_csv(save_outputs_path)
+    outputs.to_parquet(save_outputs_path)  # Columnar binary format, much faster to write than CSV
     metrics.to_csv(save_metrics_path)
     print(f'Saved outputs at: {save_metrics_path}\n')
     print(f'Saved metrics at: {save_metrics_path}\n')
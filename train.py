@@ -4,18 +4,19 @@ import neptune
 from neptune_pytorch import NeptuneLogger
 from pcam import get_dataloaders, get_model, train
 
-# Optimization
-torch.backends.cudnn.benchmark = True
-
 # Parameters
 parser = argparse.ArgumentParser(description="Train script",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("-model", choices=['AlexNet', 'VGG-16', 'VGG-11', 'GoogleNet', 'Inception-v3',
 'ResNet-18', 'DenseNet-161', 'Swin-v2-Base', 'Vit-b-16'], help="Model name")
 parser.add_argument("-augment", action='store_true', default=False, help="To add data augmentations or not")
+parser.add_argument("-cache", action='store_true', default=False,
+                    help="To cache decoded images in memory or not (in shared memory /dev/shm with dataloader workers, "
+                         "about 0.9 GB for the test split and 7.2 GB for the train split)")
 parser.add_argument("-batch", type=int, default=256, help="Batch size")
 parser.add_argument("-epochs", type=int, default=5, help="Number of epochs")
 parser.add_argument("-classes", type=int, default=2, help="Number of classes")
+parser.add_argument("-accum_steps", type=int, default=1, help="Number of batches to accumulate gradients over")
 parser.add_argument("-lr", type=float, default=0.001, help="Learning rate")
 parser.add_argument("-save_model", default=None, help="Path to save checkpoint")
 parser.add_argument("-data_path", default='data', help="Path to load data from")
@@ -36,13 +37,13 @@ if 'Swin' in config['model']:
 else:
     resize = 96
 train_loader, val_loader, test_loader = get_dataloaders(config['data_path'], batch_size=config['batch'], resize=resize,
-                                                        augment=config['augment'])
+                                                        augment=config['augment'], cache=config['cache'])
 
 # Model
 model = get_model(config['model'], device)
 
 # Optimizer
-optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'])
+optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=config['lr'])  # Only unfrozen layers
 
 # Scheduler
 scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=config['lr'], epochs=config['epochs'],
@@ -74,7 +75,8 @@ else:
 
 # Train
 train(model, train_loader, val_loader, loss_fun, optimizer, scheduler, num_epochs=config['epochs'],
-      num_classes=config['classes'], augment=config['augment'], device=device, save_ckpt_path=config['save_model'], logger=logger, run=run)
+      num_classes=config['classes'], augment=config['augment'], accum_steps=config['accum_steps'], device=device,
+      save_ckpt_path=config['save_model'], logger=logger, run=run)
 
 # Stop Neptune logger
 if run: